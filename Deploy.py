@@ -19,12 +19,22 @@ from __future__ import annotations
 
 from Furious.Utility import *
 
+from typing import Callable
+
 import os
 import sys
 import shutil
+import json
 import logging
+import functools
 import argparse
+import dataclasses
+import threading
 import subprocess
+import urllib.parse
+import urllib.error
+import urllib.request
+import concurrent.futures
 
 logging.basicConfig(
     format='[%(asctime)s] [%(name)s] [%(levelname)s] %(message)s',
@@ -40,50 +50,96 @@ EXIT_FAILURE = 1
 
 DEPLOY_DIR_NAME = f'{APPLICATION_NAME}-Deploy'
 
-if PLATFORM == 'Windows':
-    NUITKA_BUILD = (
-        f'python -m nuitka '
-        f'--standalone --plugin-enable=pyside6 '
-        f'--disable-console '
-        f'--assume-yes-for-downloads '
-        f'--include-package-data=Furious '
-        f'--windows-icon-from-ico=\"Icons/png/rocket-takeoff-window.png\" '
-        f'--force-stdout-spec=^%TEMP^%/_Furious_Enable_Stdout '
-        f'--force-stderr-spec=^%TEMP^%/_Furious_Enable_Stderr '
-        f'Furious '
-        f'--output-dir=\"{ROOT_DIR / DEPLOY_DIR_NAME}\"'
-    )
-elif PLATFORM == 'Darwin':
-    NUITKA_BUILD = (
-        f'python -m nuitka '
-        f'--standalone --plugin-enable=pyside6 '
-        f'--disable-console '
-        f'--assume-yes-for-downloads '
-        f'--include-package-data=Furious '
-        f'--macos-create-app-bundle '
-        f'--macos-app-icon=\"Icons/png/rocket-takeoff-window.png\" '
-        f'--macos-app-name=\"Furious\" '
-        f'Furious-GUI.py '
-        f'--output-dir=\"{ROOT_DIR / DEPLOY_DIR_NAME}\"'
-    )
-else:
-    # Deploy: Not implemented
-    NUITKA_BUILD = ''
+# 1 MiB
+DOWNLOAD_CHUNK_SIZE = 1 << 20
+
+# Stores ETag and partial files of downloaded assets. Kept outside the
+# package data dir so they are never shipped. Same volume as the data
+# dir, so replacing a finished download is atomic
+DOWNLOAD_CACHE_DIR = ROOT_DIR / f'{APPLICATION_NAME}-Download-Cache'
+
+MAC_APP_DIR = ROOT_DIR / 'app'
+
+
+@dataclasses.dataclass(frozen=True)
+class PlatformOps:
+    build: Callable[[], list]
+    artifact: str
+    cleanupTasks: Callable[[], dict]
+    postBuild: Callable[[argparse.Namespace], None]
 
-if PLATFORM == 'Windows':
+
+def nuitkaBuild(*options) -> list:
+    return [
+        sys.executable,
+        '-m',
+        'nuitka',
+        '--standalone',
+        '--plugin-enable=pyside6',
+        '--disable-console',
+        '--assume-yes-for-downloads',
+        '--include-package-data=Furious',
+        *options,
+        f'--output-dir={ROOT_DIR / DEPLOY_DIR_NAME}',
+    ]
+
+
+def windowsPlatformOps() -> PlatformOps:
     if PLATFORM_RELEASE.endswith('Server'):
         # Windows server. Fixed to windows10
         winVerCompatible = f'{PLATFORM.lower()}10'
     else:
         winVerCompatible = f'{PLATFORM.lower()}{PLATFORM_RELEASE}'
 
-    ARTIFACT_NAME = (
+    artifact = (
         f'{APPLICATION_NAME}-{APPLICATION_VERSION}-'
         f'{winVerCompatible}-{PLATFORM_MACHINE.lower()}'
     )
+    unzipped = f'{APPLICATION_NAME}-{APPLICATION_VERSION}-{winVerCompatible}'
 
-    WIN_UNZIPPED = f'{APPLICATION_NAME}-{APPLICATION_VERSION}-{winVerCompatible}'
-elif PLATFORM == 'Darwin':
+    def cleanupTasks():
+        # More cleanup on Windows
+        return {
+            'remove artifact': functools.partial(
+                os.remove, ROOT_DIR / f'{artifact}.zip'
+            ),
+            'remove unzipped dir': functools.partial(
+                shutil.rmtree, ROOT_DIR / unzipped
+            ),
+        }
+
+    def postBuild(args):
+        try:
+            shutil.rmtree(ROOT_DIR / DEPLOY_DIR_NAME / unzipped)
+        except FileNotFoundError:
+            pass
+        except Exception:
+            # Any non-exit exceptions
+
+            raise
+
+        # The dist dir is not reused afterwards. Rename instead of copy
+        os.rename(
+            ROOT_DIR / DEPLOY_DIR_NAME / f'{APPLICATION_NAME}.dist',
+            ROOT_DIR / DEPLOY_DIR_NAME / unzipped,
+        )
+        makeZipArchive(artifact, unzipped)
+
+    return PlatformOps(
+        build=functools.partial(
+            nuitkaBuild,
+            '--windows-icon-from-ico=Icons/png/rocket-takeoff-window.png',
+            '--force-stdout-spec=%TEMP%/_Furious_Enable_Stdout',
+            '--force-stderr-spec=%TEMP%/_Furious_Enable_Stderr',
+            'Furious',
+        ),
+        artifact=artifact,
+        cleanupTasks=cleanupTasks,
+        postBuild=postBuild,
+    )
+
+
+def darwinPlatformOps() -> PlatformOps:
     value = versionToValue(PYSIDE6_VERSION)
 
     # https://doc.qt.io/qt-6/supported-platforms.html
@@ -94,59 +150,237 @@ elif PLATFORM == 'Darwin':
     else:
         macVerCompatible = 'macOS-12.0'
 
-    ARTIFACT_NAME = (
+    artifact = (
         f'{APPLICATION_NAME}-{APPLICATION_VERSION}-'
         f'{macVerCompatible}-{PLATFORM_MACHINE.lower()}'
     )
+    dmgFilename = f'{artifact}.dmg'
+
+    def cleanupTasks():
+        # More cleanup on Darwin
+        return {
+            'remove artifact': functools.partial(os.remove, ROOT_DIR / dmgFilename),
+            'remove app dir': functools.partial(shutil.rmtree, MAC_APP_DIR),
+        }
+
+    def postBuild(args):
+        try:
+            shutil.rmtree(MAC_APP_DIR)
+        except FileNotFoundError:
+            pass
+        except Exception:
+            # Any non-exit exceptions
+
+            raise
+
+        try:
+            os.mkdir(MAC_APP_DIR)
+        except Exception:
+            # Any non-exit exceptions
+
+            raise
+
+        # The app bundle is not reused afterwards. Rename instead of copy
+        os.rename(
+            ROOT_DIR / DEPLOY_DIR_NAME / 'Furious-GUI.app',
+            MAC_APP_DIR / 'Furious-GUI.app',
+        )
+
+        logger.info('generating dmg')
+
+        try:
+            result = runExternalCommand(
+                macCreateDMGCommand(dmgFilename, args.polish),
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                check=True,
+            )
+        except subprocess.CalledProcessError as err:
+            logger.error(f'generate dmg failed with returncode {err.returncode}')
 
-    MAC_APP_DIR = ROOT_DIR / 'app'
-    MAC_DMG_FILENAME = f'{ARTIFACT_NAME}.dmg'
-    MAC_CREATE_DMG_CMD = (
-        f'create-dmg '
-        f'--volname \"Furious\" '
-        f'--volicon \"Icons/png/rocket-takeoff-window.png\" '
-        f'--window-pos 200 120 '
-        f'--window-size 600 300 '
-        f'--icon-size 100 '
-        f'--icon \"Furious-GUI.app\" 175 120 '
-        f'--hide-extension \"Furious-GUI.app\" '
-        f'--app-drop-link 425 120 '
-        f'\"{ROOT_DIR / MAC_DMG_FILENAME}\" '
-        f'\"{MAC_APP_DIR}\"'
+            printStandardStream(err.stdout, err.stderr)
+
+            sys.exit(EXIT_FAILURE)
+        else:
+            logger.info(f'generate dmg success: {dmgFilename}')
+
+            printStandardStream(result.stdout, result.stderr)
+
+    return PlatformOps(
+        build=functools.partial(
+            nuitkaBuild,
+            '--macos-create-app-bundle',
+            '--macos-app-icon=Icons/png/rocket-takeoff-window.png',
+            '--macos-app-name=Furious',
+            'Furious-GUI.py',
+        ),
+        artifact=artifact,
+        cleanupTasks=cleanupTasks,
+        postBuild=postBuild,
     )
-else:
+
+
+def defaultPlatformOps() -> PlatformOps:
     # Deploy: Not implemented
-    ARTIFACT_NAME = ''
+    return PlatformOps(
+        build=lambda: [],
+        artifact='',
+        cleanupTasks=lambda: {},
+        postBuild=lambda args: None,
+    )
 
 
-def downloadXrayAssets(url, filename):
-    try:
-        import requests
-    except ImportError:
-        raise ModuleNotFoundError('missing requests module')
+@functools.lru_cache(maxsize=None)
+def platformOps() -> PlatformOps:
+    # Resolve the platform branch once
+    if PLATFORM == 'Windows':
+        return windowsPlatformOps()
+    elif PLATFORM == 'Darwin':
+        return darwinPlatformOps()
+    else:
+        return defaultPlatformOps()
+
+
+def macCreateDMGCommand(dmgFilename: str, polish: bool = False) -> list:
+    if polish:
+        # Custom window layout. Mounts and re-lays-out the image
+        return [
+            'create-dmg',
+            '--volname',
+            'Furious',
+            '--volicon',
+            'Icons/png/rocket-takeoff-window.png',
+            '--window-pos',
+            '200',
+            '120',
+            '--window-size',
+            '600',
+            '300',
+            '--icon-size',
+            '100',
+            '--icon',
+            'Furious-GUI.app',
+            '175',
+            '120',
+            '--hide-extension',
+            'Furious-GUI.app',
+            '--app-drop-link',
+            '425',
+            '120',
+            str(ROOT_DIR / dmgFilename),
+            str(MAC_APP_DIR),
+        ]
+    else:
+        # Single hdiutil pass. No layout
+        return [
+            'hdiutil',
+            'create',
+            '-srcfolder',
+            str(MAC_APP_DIR),
+            '-format',
+            'UDZO',
+            '-imagekey',
+            'zlib-level=9',
+            '-volname',
+            'Furious',
+            '-ov',
+            str(ROOT_DIR / dmgFilename),
+        ]
 
-    try:
-        # Make sure the save directory exists
-        if not os.path.exists(XRAY_ASSET_DIR):
-            os.makedirs(XRAY_ASSET_DIR)
 
-        # Full path where the file will be saved
-        filepath = os.path.join(XRAY_ASSET_DIR, filename)
+def downloadXrayAssets(url, filename):
+    # Full path where the file will be saved
+    filepath = os.path.join(XRAY_ASSET_DIR, filename)
+    partpath = os.path.join(DOWNLOAD_CACHE_DIR, f'{filename}.part')
+    etagpath = os.path.join(DOWNLOAD_CACHE_DIR, f'{filename}.etag.json')
 
-        # Send an HTTP GET request to the URL
-        response = requests.get(url)
-        response.raise_for_status()  # Check if the request was successful
+    headers = {'User-Agent': f'{APPLICATION_NAME}-Deploy'}
 
-        # Open the save_path in write-binary mode and write the content of the response
-        with open(filepath, 'wb') as file:
-            file.write(response.content)
+    try:
+        # Make sure the save directory exists. Other download
+        # threads may be creating it at the same time
+        os.makedirs(XRAY_ASSET_DIR, exist_ok=True)
+        os.makedirs(DOWNLOAD_CACHE_DIR, exist_ok=True)
+
+        if os.path.exists(filepath) and os.path.exists(etagpath):
+            try:
+                with open(etagpath, 'r', encoding='utf-8') as file:
+                    cache = json.load(file)
+            except ValueError:
+                # Corrupted cache. Download unconditionally
+                cache = {}
+
+            if not isinstance(cache, dict):
+                # Corrupted cache. Download unconditionally
+                cache = {}
+
+            stat = os.stat(filepath)
+
+            # ETag is only valid for the exact file it was saved with.
+            # The asset may have been replaced since, e.g. by git checkout
+            if (
+                cache.get('etag')
+                and cache.get('size') == stat.st_size
+                and cache.get('mtime') == stat.st_mtime_ns
+            ):
+                headers['If-None-Match'] = cache['etag']
+
+        # Send an HTTP GET request to the URL. Stream the body
+        with urllib.request.urlopen(
+            urllib.request.Request(url, headers=headers), timeout=30
+        ) as response:
+            # Write the response to disk chunk by chunk. Only move it
+            # into place once complete, so a crash never leaves a
+            # truncated asset behind
+            with open(partpath, 'wb') as file:
+                shutil.copyfileobj(response, file, DOWNLOAD_CHUNK_SIZE)
+
+                received = file.tell()
+
+            # urllib does not raise when the connection closes early
+            expected = response.headers.get('Content-Length')
+
+            if expected is not None and received != int(expected):
+                raise OSError(
+                    f'incomplete download: received {received} of {expected} bytes'
+                )
+
+            os.replace(partpath, filepath)
+
+            stat = os.stat(filepath)
+
+            with open(etagpath, 'w', encoding='utf-8') as file:
+                json.dump(
+                    {
+                        'etag': response.headers.get('ETag', ''),
+                        'size': stat.st_size,
+                        'mtime': stat.st_mtime_ns,
+                    },
+                    file,
+                )
+
+    except urllib.error.HTTPError as ex:
+        ex.close()
+
+        if ex.code == 304:
+            logger.info(f'file not modified, skipped: {filepath}')
+
+            return True
+
+        logger.error(f'failed to download file from {url}: {ex}')
 
+        return False
     except Exception as ex:
         # Any non-exit exceptions
 
-        logger.error(
-            f'failed to download file from {url}. Status code: {response.status_code}'
-        )
+        try:
+            os.remove(partpath)
+        except Exception:
+            # Any non-exit exceptions
+
+            pass
+
+        logger.error(f'failed to download file from {url}: {ex}')
 
         return False
     else:
@@ -155,61 +389,56 @@ def downloadXrayAssets(url, filename):
         return True
 
 
-def cleanup():
-    try:
-        shutil.rmtree(ROOT_DIR / DEPLOY_DIR_NAME)
-    except Exception as ex:
-        # Any non-exit exceptions
+def removeConcurrently(tasks):
+    # Independent filesystem operations. Run them concurrently
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(tasks)) as executor:
+        futures = {executor.submit(task): name for name, task in tasks.items()}
 
-        logger.error(f'remove deployment dir failed: {ex}')
-    else:
-        logger.info(f'remove deployment dir success')
+        for future in concurrent.futures.as_completed(futures):
+            name = futures[future]
 
-    if PLATFORM == 'Windows':
-        # More cleanup on Windows
-        try:
-            # Remove artifact
-            os.remove(ROOT_DIR / f'{ARTIFACT_NAME}.zip')
-        except Exception as ex:
-            # Any non-exit exceptions
+            try:
+                future.result()
+            except Exception as ex:
+                # Any non-exit exceptions
 
-            logger.error(f'remove artifact failed: {ex}')
-        else:
-            logger.info(f'remove artifact success')
+                logger.error(f'{name} failed: {ex}')
+            else:
+                logger.info(f'{name} success')
 
-        try:
-            # Remove unzipped folder
-            shutil.rmtree(ROOT_DIR / WIN_UNZIPPED)
-        except Exception as ex:
-            # Any non-exit exceptions
 
-            logger.error(f'remove unzipped dir failed: {ex}')
-        else:
-            logger.info('remove unzipped dir success')
-    elif PLATFORM == 'Darwin':
-        # More cleanup on Darwin
-        try:
-            # Remove artifact
-            os.remove(ROOT_DIR / f'{ARTIFACT_NAME}.dmg')
-        except Exception as ex:
-            # Any non-exit exceptions
+def cleanup():
+    removeConcurrently(
+        {
+            'remove deployment dir': functools.partial(
+                shutil.rmtree, ROOT_DIR / DEPLOY_DIR_NAME
+            ),
+            **platformOps().cleanupTasks(),
+        }
+    )
 
-            logger.error(f'remove artifact failed: {ex}')
-        else:
-            logger.info(f'remove artifact success')
 
-        try:
-            # Remove app folder
-            shutil.rmtree(MAC_APP_DIR)
-        except Exception as ex:
-            # Any non-exit exceptions
+def downloadMany(pairs, connsPerHost=4):
+    if not pairs:
+        return []
 
-            logger.error(f'remove app dir failed: {ex}')
-        else:
-            logger.info(f'remove app dir success')
-    else:
-        # Deploy: Not implemented
-        pass
+    # Downloads are network-bound. Run them concurrently, but cap
+    # in-flight requests per host so the release CDN is not hammered
+    semaphores = {
+        urllib.parse.urlsplit(url).netloc: threading.Semaphore(connsPerHost)
+        for url, filename in pairs
+    }
+
+    def downloadOne(url, filename):
+        with semaphores[urllib.parse.urlsplit(url).netloc]:
+            return downloadXrayAssets(url, filename)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(pairs)) as executor:
+        futures = [
+            executor.submit(downloadOne, url, filename) for url, filename in pairs
+        ]
+
+        return [future.result() for future in futures]
 
 
 def download():
@@ -222,25 +451,113 @@ def download():
     filename_geoip = 'geoip.dat'
 
     return all(
-        [
-            downloadXrayAssets(url_geosite, filename_geosite),
-            downloadXrayAssets(url_geoip, filename_geoip),
-        ]
+        downloadMany(
+            [
+                (url_geosite, filename_geosite),
+                (url_geoip, filename_geoip),
+            ]
+        )
     )
 
 
 def printStandardStream(stdout, stderr):
-    if isinstance(stdout, bytes):
-        decoded_stdout = stdout.decode('utf-8', 'replace')
-    else:
-        decoded_stdout = stdout
+    # Write raw bytes directly. No decode pass and no concatenated copy
+    sys.stdout.flush()
 
-    if isinstance(stderr, bytes):
-        decoded_stderr = stderr.decode('utf-8', 'replace')
-    else:
-        decoded_stderr = stderr
+    buffer = sys.stdout.buffer
+
+    for header, stream in ((b'stdout:\n', stdout), (b'stderr:\n', stderr)):
+        buffer.write(header)
+
+        if isinstance(stream, bytes):
+            buffer.write(stream)
+        elif stream:
+            buffer.write(stream.encode('utf-8', 'replace'))
+
+    buffer.flush()
+
+
+def runStreamingCommand(*args, **kwargs):
+    if PLATFORM == 'Windows':
+        # Same as runExternalCommand
+        kwargs.setdefault('creationflags', subprocess.CREATE_NO_WINDOW)
+
+    # Log output line by line as it arrives. Pipes are drained
+    # continuously so the child never blocks on a full pipe
+    process = subprocess.Popen(
+        *args,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        bufsize=1,
+        encoding='utf-8',
+        errors='replace',
+        **kwargs,
+    )
+
+    def drain(stream):
+        with stream:
+            for line in stream:
+                logger.info(line.rstrip())
+
+    threads = [
+        threading.Thread(target=drain, args=(process.stdout,), daemon=True),
+        threading.Thread(target=drain, args=(process.stderr,), daemon=True),
+    ]
+
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    return process.wait()
+
+
+def makeZipArchive(artifact, unzipped):
+    sevenZip = shutil.which('7z')
+
+    if sevenZip is None:
+        # Single-threaded fallback
+        shutil.make_archive(
+            str(ROOT_DIR / artifact),
+            'zip',
+            ROOT_DIR / DEPLOY_DIR_NAME,
+            unzipped,
+            logger=logger,
+        )
+
+        return
+
+    filepath = ROOT_DIR / f'{artifact}.zip'
+
+    try:
+        # 7z appends to an existing archive
+        os.remove(filepath)
+    except FileNotFoundError:
+        pass
+    except Exception:
+        # Any non-exit exceptions
+
+        raise
 
-    print(f'stdout:\n{decoded_stdout}stderr:\n{decoded_stderr}', flush=True)
+    logger.info(f'creating zip archive with {sevenZip}')
+
+    try:
+        runExternalCommand(
+            [sevenZip, 'a', '-tzip', '-mx=5', '-mmt=on', str(filepath), unzipped],
+            cwd=ROOT_DIR / DEPLOY_DIR_NAME,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            check=True,
+        )
+    except subprocess.CalledProcessError as err:
+        logger.error(f'create zip archive failed with returncode {err.returncode}')
+
+        printStandardStream(err.stdout, err.stderr)
+
+        sys.exit(EXIT_FAILURE)
+    else:
+        logger.info(f'create zip archive success: {filepath.name}')
 
 
 def main():
@@ -257,6 +574,12 @@ def main():
         action='store_true',
         help='Cleanup deployment files',
     )
+    parser.add_argument(
+        '-p',
+        '--polish',
+        action='store_true',
+        help='Generate dmg with custom window layout (macOS only)',
+    )
 
     args = parser.parse_args()
 
@@ -279,91 +602,25 @@ def main():
 
     logger.info('building')
 
-    try:
-        result = runExternalCommand(
-            NUITKA_BUILD,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            shell=True,
-            check=True,
-        )
-    except subprocess.CalledProcessError as err:
-        logger.error(f'build failed with returncode {err.returncode}')
+    ops = platformOps()
 
-        printStandardStream(err.stdout, err.stderr)
+    build = ops.build()
 
-        sys.exit(EXIT_FAILURE)
-    else:
-        logger.info(f'build success')
+    if not build:
+        logger.info(f'deploy not implemented on {PLATFORM}')
 
-        printStandardStream(result.stdout, result.stderr)
-
-    if PLATFORM == 'Windows':
-        try:
-            shutil.rmtree(ROOT_DIR / DEPLOY_DIR_NAME / WIN_UNZIPPED)
-        except FileNotFoundError:
-            pass
-        except Exception:
-            # Any non-exit exceptions
-
-            raise
-
-        shutil.copytree(
-            ROOT_DIR / DEPLOY_DIR_NAME / f'{APPLICATION_NAME}.dist',
-            ROOT_DIR / DEPLOY_DIR_NAME / WIN_UNZIPPED,
-        )
-        shutil.make_archive(
-            ARTIFACT_NAME,
-            'zip',
-            ROOT_DIR / DEPLOY_DIR_NAME,
-            WIN_UNZIPPED,
-            logger=logger,
-        )
-    elif PLATFORM == 'Darwin':
-        try:
-            shutil.rmtree(MAC_APP_DIR)
-        except FileNotFoundError:
-            pass
-        except Exception:
-            # Any non-exit exceptions
-
-            raise
-
-        try:
-            os.mkdir(MAC_APP_DIR)
-        except Exception:
-            # Any non-exit exceptions
-
-            raise
-
-        shutil.copytree(
-            ROOT_DIR / DEPLOY_DIR_NAME / 'Furious-GUI.app',
-            MAC_APP_DIR / 'Furious-GUI.app',
-        )
-
-        logger.info('generating dmg')
-
-        try:
-            result = runExternalCommand(
-                MAC_CREATE_DMG_CMD,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                shell=True,
-                check=True,
-            )
-        except subprocess.CalledProcessError as err:
-            logger.error(f'generate dmg failed with returncode {err.returncode}')
+        sys.exit(EXIT_SUCCESS)
 
-            printStandardStream(err.stdout, err.stderr)
+    returncode = runStreamingCommand(build)
 
-            sys.exit(EXIT_FAILURE)
-        else:
-            logger.info(f'generate dmg success: {MAC_DMG_FILENAME}')
+    if returncode != 0:
+        logger.error(f'build failed with returncode {returncode}')
 
-            printStandardStream(result.stdout, result.stderr)
+        sys.exit(EXIT_FAILURE)
     else:
-        # Deploy: Not implemented
-        pass
+        logger.info(f'build success')
+
+    ops.postBuild(args)
 
     sys.exit(EXIT_SUCCESS)
 